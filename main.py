@@ -1,36 +1,105 @@
 import asyncio
 import os
+import sys
+import queue
+import logging
+import logging.handlers
 from dotenv import load_dotenv
-import aiohttp
+import httpx
 
 load_dotenv()
 
 from google.oauth2 import service_account
 import google.auth.transport.requests
 from shazamio import Shazam
+from shazamio.exceptions import FailedDecodeJson
+from shazamio.interfaces.client import HTTPClientInterface
+import aiohttp
+from aiohttp_retry import RetryClient, ExponentialRetry
+import ssl
 import time
+import datetime
 import argparse
 import json
 import random
+import collections
+import orjson
+from aiolimiter import AsyncLimiter
+
+try:
+    import uvloop
+except ImportError:  # uvloop 미지원 환경 (Windows 등): 기본 asyncio 루프 사용
+    uvloop = None
+
+log = logging.getLogger("shazam")
+
+def setup_logging():
+    """
+    Route log records through a queue: the event loop only enqueues,
+    and a background thread does the actual (possibly slow) stdout writes.
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%d %H:%M:%S"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    listener.start()
+    return listener
+
+LOG_LISTENER = setup_logging()
 
 SEGMENT_DURATION = 15  # 분석할 오디오 길이 (초) - 정확도 향상
+CYCLE_GAP = 30  # 세그먼트 사이 간격 (초): 인식 주기 = SEGMENT_DURATION + CYCLE_GAP
+TOKEN_REFRESH_MARGIN = 60  # 만료 N초 전부터는 캐시된 토큰을 사용하지 않음
+TOKEN_PROACTIVE_MARGIN = 300  # 백그라운드 갱신: 만료 N초 전에 미리 갱신
+HISTORY_FLUSH_INTERVAL = 60  # 히스토리를 모아서 저장하는 최대 대기 시간 (초)
+HISTORY_BATCH_SIZE = 10  # 이 개수만큼 쌓이면 대기 시간과 관계없이 즉시 저장
+CAPTURE_RESTART_DELAY = 5  # ffmpeg 종료 시 재시작 전 대기 (초)
+ADTS_READ_CHUNK = 4096  # ffmpeg stdout에서 한 번에 읽는 바이트 수
+ADTS_PROBE_FRAMES = 50  # 비트레이트 측정에 사용할 ADTS 프레임 수 (~1초)
+SHAZAM_RATE_PERIOD = 5.0  # Shazam API 호출 간 최소 평균 간격 (초, 토큰 버킷)
 
 # Firebase 설정
 CRED_PATH = os.getenv("SHAZAMIO_CRED_PATH", "serviceAccountKey.json")
 DATABASE_URL = os.getenv("SHAZAMIO_DATABASE_URL", "https://tbsapp-function-default-rtdb.asia-southeast1.firebasedatabase.app")
  
 
+JSON_HEADERS = {"Content-Type": "application/json"}
+# ADTS sampling_frequency_index -> Hz
+ADTS_SAMPLE_RATES = [96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050,
+                     16000, 12000, 11025, 8000, 7350, 0, 0, 0]
+# Firebase push ID alphabet (ordered so IDs sort chronologically)
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+
 # Global credentials object
 firebase_creds = None
+# Cached access token: (token, expiry epoch seconds)
+_TOKEN_CACHE = (None, 0.0)
+# Single-flight guard: only one credential refresh runs at a time
+_REFRESH_LOCK = asyncio.Lock()
+# Shared HTTP/2 client for Firebase REST calls (lazy-initialized)
+_HTTPX: httpx.AsyncClient | None = None
+# Shared aiohttp client for Shazam API calls, used by every channel (lazy-initialized)
+_SHAZAM_CLIENT: RetryClient | None = None
 # State management dictionaries (keyed by channel_id)
 LAST_DETECTED_KEY = {}
 LAST_SENT_STATUS = {}
+HISTORY_QUEUES = {}
+# Firebase REST URLs keyed by (channel_id, node), built on first use
+FIREBASE_URLS = {}
+
+# Push ID generator state
+_LAST_PUSH_TIME = 0
+_LAST_PUSH_RAND = [0] * 12
 
 def init_firebase_auth():
     """Load Firebase credentials for REST API"""
     global firebase_creds
     if not os.path.exists(CRED_PATH):
-        print(f"⚠️ [Firebase] Warning: '{CRED_PATH}' not found. Data will NOT be saved to DB.")
+        log.warning("⚠️ [Firebase] Warning: '%s' not found. Data will NOT be saved to DB.", CRED_PATH)
         return False
         
     try:
@@ -41,121 +110,434 @@ def init_firebase_auth():
         firebase_creds = service_account.Credentials.from_service_account_file(
             CRED_PATH, scopes=scopes
         )
-        print("✅ [Firebase] Auth initialized (REST API mode).")
+        log.info("✅ [Firebase] Auth initialized (REST API mode).")
         return True
     except Exception as e:
-        print(f"⚠️ [Firebase] Auth init failed: {e}")
+        log.warning("⚠️ [Firebase] Auth init failed: %s", e)
         return False
 
 FIREBASE_READY = init_firebase_auth()
 
-def get_access_token():
-    """helper to get a fresh access token"""
-    global firebase_creds
+async def refresh_access_token(margin):
+    """Refresh credentials in a worker thread unless the cached token is valid for more than `margin` seconds"""
+    global _TOKEN_CACHE
+    # 동시에 여러 요청이 갱신을 시도해도 실제 갱신은 한 번만 수행 (나머지는 결과를 기다림)
+    async with _REFRESH_LOCK:
+        token, exp_epoch = _TOKEN_CACHE
+        if token and time.time() < exp_epoch - margin:
+            return token
+
+        # creds.refresh()는 동기 HTTPS 요청이므로 이벤트 루프를 막지 않도록 스레드에서 실행
+        request = google.auth.transport.requests.Request()
+        await asyncio.to_thread(firebase_creds.refresh, request)
+
+        # google-auth expiry is a naive UTC datetime
+        expiry = firebase_creds.expiry
+        if expiry:
+            exp_epoch = expiry.replace(tzinfo=datetime.timezone.utc).timestamp()
+        else:
+            exp_epoch = time.time() + 3600
+        _TOKEN_CACHE = (firebase_creds.token, exp_epoch)
+        return firebase_creds.token
+
+async def get_access_token():
+    """helper to get a fresh access token (cached until shortly before expiry)"""
     if not firebase_creds:
         return None
-    
-    # Refresh if expired
-    if not firebase_creds.valid:
-        request = google.auth.transport.requests.Request()
-        firebase_creds.refresh(request)
-    
-    return firebase_creds.token
+
+    token, exp_epoch = _TOKEN_CACHE
+    if token and time.time() < exp_epoch - TOKEN_REFRESH_MARGIN:
+        return token
+
+    # Refresh if expired (or about to expire)
+    return await refresh_access_token(TOKEN_REFRESH_MARGIN)
+
+async def token_refresher():
+    """Background task: refresh the access token before it expires"""
+    while True:
+        try:
+            _, exp_epoch = _TOKEN_CACHE
+            await asyncio.sleep(max(0, exp_epoch - TOKEN_PROACTIVE_MARGIN - time.time()))
+            await refresh_access_token(TOKEN_PROACTIVE_MARGIN)
+        except Exception as e:
+            log.warning("⚠️ [Firebase] Token refresh failed: %s", e)
+            await asyncio.sleep(30)
+
+async def get_http_client():
+    """Return the shared HTTP/2 client, creating it on first use"""
+    global _HTTPX
+    if _HTTPX is None or _HTTPX.is_closed:
+        _HTTPX = httpx.AsyncClient(
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=8, keepalive_expiry=75)
+        )
+    return _HTTPX
+
+async def close_http_client():
+    """Close the shared HTTP/2 client (called at shutdown)"""
+    global _HTTPX
+    if _HTTPX is not None and not _HTTPX.is_closed:
+        await _HTTPX.aclose()
+    _HTTPX = None
+
+async def get_shazam_client():
+    """Return the shared Shazam API client, creating it on first use"""
+    global _SHAZAM_CLIENT
+    if _SHAZAM_CLIENT is None:
+        connector = aiohttp.TCPConnector(limit=20, limit_per_host=10, ssl=ssl.create_default_context())
+        # shazamio 기본값과 동일한 재시도 정책
+        retry_options = ExponentialRetry(attempts=20, max_timeout=60, statuses={500, 502, 503, 504, 429})
+        _SHAZAM_CLIENT = RetryClient(
+            client_session=aiohttp.ClientSession(connector=connector),
+            retry_options=retry_options,
+            raise_for_status=False
+        )
+    return _SHAZAM_CLIENT
+
+async def close_shazam_client():
+    """Close the shared Shazam API client (called at shutdown)"""
+    global _SHAZAM_CLIENT
+    if _SHAZAM_CLIENT is not None:
+        await _SHAZAM_CLIENT.close()
+    _SHAZAM_CLIENT = None
+
+class SharedSessionHTTPClient(HTTPClientInterface):
+    """
+    shazamio HTTP client that sends every request through the shared aiohttp session,
+    so all channels reuse the same TLS connections to amp.shazam.com
+    (shazamio's default client opens a new session per request).
+    """
+
+    async def request(self, method, url, *args, **kwargs):
+        client = await get_shazam_client()
+        async with client.request(method.upper(), url, **kwargs) as resp:
+            try:
+                # shazamio passes the expected content type positionally (same as its own client)
+                return await resp.json(content_type=args[0] if args else "application/json")
+            except (aiohttp.ContentTypeError, json.JSONDecodeError) as e:
+                reason = await resp.text()
+                raise FailedDecodeJson(f"Failed to decode json: {e}\nResponse: {reason}")
+
+SHAZAM_HTTP_CLIENT = SharedSessionHTTPClient()
+
+def generate_push_id():
+    """Generate a Firebase-style push ID client-side (same format POST would create)"""
+    global _LAST_PUSH_TIME
+    now = int(time.time() * 1000)
+
+    if now == _LAST_PUSH_TIME:
+        # 같은 밀리초 내 생성: 랜덤 부분을 1 증가시켜 순서 유지
+        for i in range(11, -1, -1):
+            if _LAST_PUSH_RAND[i] < 63:
+                _LAST_PUSH_RAND[i] += 1
+                break
+            _LAST_PUSH_RAND[i] = 0
+    else:
+        for i in range(12):
+            _LAST_PUSH_RAND[i] = random.randrange(64)
+    _LAST_PUSH_TIME = now
+
+    time_chars = []
+    for _ in range(8):
+        time_chars.append(PUSH_CHARS[now % 64])
+        now //= 64
+    return "".join(reversed(time_chars)) + "".join(PUSH_CHARS[c] for c in _LAST_PUSH_RAND)
+
+def get_firebase_url(channel_id, node):
+    """Return the REST URL for a channel's node (URLs are token-free, so they can be cached)"""
+    key = (channel_id, node)
+    if key not in FIREBASE_URLS:
+        # URLs (Option A: Sub-paths)
+        # Remove trailing slash from DATABASE_URL if present
+        base_url = DATABASE_URL.rstrip('/')
+        FIREBASE_URLS[key] = f"{base_url}/tbs_radio/{channel_id}/{node}.json"
+    return FIREBASE_URLS[key]
+
+def firebase_headers(token):
+    """Request headers with the access token (sent as a header so it never appears in URLs/logs)"""
+    return {**JSON_HEADERS, "Authorization": f"Bearer {token}"}
+
+def get_history_queue(channel_id):
+    """Return the pending-history queue for a channel, creating it on first use"""
+    if channel_id not in HISTORY_QUEUES:
+        HISTORY_QUEUES[channel_id] = asyncio.Queue()
+    return HISTORY_QUEUES[channel_id]
 
 async def save_to_firebase_rest(data, channel_id):
-    """Save data to Firebase RTDB via REST API for a specific channel"""
+    """
+    Save data to Firebase RTDB via REST API for a specific channel.
+    Timestamps are added to `data` in place (the track dict is not used after saving).
+    """
     if not FIREBASE_READY or not firebase_creds:
         return
 
-    token = get_access_token()
+    try:
+        token = await get_access_token()
+    except Exception as e:
+        token = None
+        log.error("   [%s] -> ❌ Token refresh failed: %s", channel_id, e)
     if not token:
-        print(f"   [{channel_id}] -> ❌ Firebase Token Error")
+        log.error("   [%s] -> ❌ Firebase Token Error", channel_id)
         return
 
-    # Data to save
-    db_data = data.copy()
-    db_data['timestamp_server'] = int(time.time())
-    db_data['detected_at_readable'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    # Data to save (복사 없이 원본 dict에 타임스탬프 추가)
+    now = int(time.time())
+    db_data = data
+    db_data['timestamp_server'] = now
+    db_data['detected_at_readable'] = datetime.datetime.fromtimestamp(now).isoformat(sep=' ')
 
-    # URLs (Option A: Sub-paths)
-    # Remove trailing slash from DATABASE_URL if present
-    base_url = DATABASE_URL.rstrip('/')
-    now_playing_url = f"{base_url}/tbs_radio/{channel_id}/now_playing.json?access_token={token}"
-    history_url = f"{base_url}/tbs_radio/{channel_id}/history.json?access_token={token}"
+    # 2. Add to History: history_flusher가 모아서 한 번에 저장 (push ID는 감지 시점에 생성)
+    get_history_queue(channel_id).put_nowait((generate_push_id(), db_data))
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            # 1. Update Now Playing (PUT replaces data)
-            async with session.put(now_playing_url, json=db_data) as resp:
-                if resp.status != 200:
-                    print(f"   [{channel_id}] -> ❌ Now Playing Update Failed: {resp.status} {await resp.text()}")
-
-            # 2. Add to History (POST generates new ID)
-            async with session.post(history_url, json=db_data) as resp:
-                 if resp.status != 200:
-                    print(f"   [{channel_id}] -> ❌ History Save Failed: {resp.status} {await resp.text()}")
-                 else:
-                    print(f"   [{channel_id}] -> 📤 Saved to Firebase RTDB (REST)")
-                    
-        except Exception as e:
-            print(f"   [{channel_id}] -> ❌ REST API Request Error: {e}")
+    client = await get_http_client()
+    try:
+        # 1. Update Now Playing (PUT replaces data)
+        resp = await client.put(
+            get_firebase_url(channel_id, "now_playing"),
+            content=orjson.dumps(db_data),
+            headers=firebase_headers(token)
+        )
+        if resp.status_code != 200:
+            log.error("   [%s] -> ❌ Now Playing Update Failed: %s %s", channel_id, resp.status_code, resp.text)
+        else:
+            log.info("   [%s] -> 📤 Saved to Firebase RTDB (REST)", channel_id)
+    except Exception as e:
+        log.error("   [%s] -> ❌ REST API Request Error: %s", channel_id, e)
+
+async def flush_history_rest(entries, channel_id):
+    """Write a batch of history entries ({push_id: entry}) with a single PATCH (returns True on success)"""
+    try:
+        token = await get_access_token()
+        if not token:
+            log.error("   [%s] -> ❌ Firebase Token Error", channel_id)
+            return False
+
+        client = await get_http_client()
+        # PATCH = multi-path update: 각 push ID 아래에 항목이 추가됨
+        resp = await client.patch(
+            get_firebase_url(channel_id, "history"),
+            content=orjson.dumps(entries),
+            headers=firebase_headers(token)
+        )
+        if resp.status_code != 200:
+            log.error("   [%s] -> ❌ History Save Failed: %s %s", channel_id, resp.status_code, resp.text)
+            return False
+        log.info("   [%s] -> 📤 Saved %s history entries to Firebase RTDB (REST)", channel_id, len(entries))
+        return True
+    except Exception as e:
+        log.error("   [%s] -> ❌ History Request Error: %s", channel_id, e)
+        return False
+
+async def history_flusher(channel_id):
+    """Background task: drain the channel's history queue and batch-write it"""
+    history_queue = get_history_queue(channel_id)
+    pending = {}
+    try:
+        while True:
+            try:
+                # 첫 항목이 들어올 때까지 대기한 뒤, 일정 시간 동안 추가 항목을 모음
+                # 저장에 실패한 항목이 남아 있으면 새 항목이 없어도 HISTORY_FLUSH_INTERVAL 후 재시도
+                first_timeout = HISTORY_FLUSH_INTERVAL if pending else None
+                try:
+                    push_id, entry = await asyncio.wait_for(history_queue.get(), first_timeout)
+                except asyncio.TimeoutError:
+                    pass
+                else:
+                    pending[push_id] = entry
+                    deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+
+                    while len(pending) < HISTORY_BATCH_SIZE:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                        try:
+                            push_id, entry = await asyncio.wait_for(history_queue.get(), timeout)
+                        except asyncio.TimeoutError:
+                            break
+                        pending[push_id] = entry
+
+                # 실패한 항목은 남겨두고 재시도
+                if await flush_history_rest(pending, channel_id):
+                    pending = {}
+            except Exception as e:
+                # TaskGroup 안에서 실행되므로 예외가 밖으로 나가면 모든 채널이 종료됨: 기록 후 계속 실행
+                log.error("   [%s] -> ❌ History Flusher Error: %s", channel_id, e)
+                await asyncio.sleep(HISTORY_FLUSH_INTERVAL)
+    finally:
+        # 종료 시 남은 항목 저장 (flush_history_rest는 실패 시 예외 대신 False 반환)
+        while not history_queue.empty():
+            push_id, entry = history_queue.get_nowait()
+            pending[push_id] = entry
+        if pending:
+            await flush_history_rest(pending, channel_id)
 
 async def clear_now_playing_rest(channel_id):
-    """Clear the now_playing node in Firebase dict for a specific channel"""
+    """Clear the now_playing node in Firebase dict for a specific channel (returns True on success)"""
     if not FIREBASE_READY or not firebase_creds:
-        return
+        return False
 
-    token = get_access_token()
-    if not token:
-        return
+    try:
+        token = await get_access_token()
+        if not token:
+            return False
+
+        client = await get_http_client()
+        # Delete the node (idempotent, no request body)
+        resp = await client.delete(get_firebase_url(channel_id, "now_playing"), headers=firebase_headers(token))
+        if resp.status_code != 200:
+            log.error("   [%s] -> ❌ Clear Now Playing Failed: %s", channel_id, resp.status_code)
+            return False
+        return True
+    except Exception as e:
+        log.error("   [%s] -> ❌ Clear Request Error: %s", channel_id, e)
+        return False
 
-    # Delete or set to null
-    base_url = DATABASE_URL.rstrip('/')
-    now_playing_url = f"{base_url}/tbs_radio/{channel_id}/now_playing.json?access_token={token}"
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            # Send empty JSON {} to clear
-            async with session.put(now_playing_url, json={}) as resp:
-                if resp.status != 200:
-                    print(f"   [{channel_id}] -> ❌ Clear Now Playing Failed: {resp.status}")
-                # else:
-                #    print(f"   [{channel_id}] -> 🗑️ Now playing cleared.")
-        except Exception as e:
-            print(f"   [{channel_id}] -> ❌ Clear Request Error: {e}")
+def new_audio_buffer():
+    """Rolling buffer holding roughly the most recent SEGMENT_DURATION seconds of ADTS bytes"""
+    return {"chunks": collections.deque(), "ready": asyncio.Event()}
 
+def reset_audio_buffer(buffer):
+    buffer["chunks"] = collections.deque()
+    buffer["ready"].clear()
 
-async def capture_audio_segment(url, duration, output_file):
+def parse_adts_header(header):
+    """Return (frame_length, frame_duration) for a 7-byte ADTS header, or None if it is not one"""
+    if len(header) < 7 or header[0] != 0xFF or (header[1] & 0xF0) != 0xF0:
+        return None
+    sample_rate = ADTS_SAMPLE_RATES[(header[2] >> 2) & 0x0F]
+    frame_length = ((header[3] & 0x03) << 11) | (header[4] << 3) | (header[5] >> 5)
+    if not sample_rate or frame_length < 7:
+        return None
+    blocks = (header[6] & 0x03) + 1
+    return frame_length, blocks * 1024 / sample_rate
+
+async def probe_window_bytes(stream, buffer):
+    """
+    스트림 앞부분의 ADTS 프레임 헤더로 비트레이트를 측정하여
+    SEGMENT_DURATION초 분량이 몇 바이트인지 계산합니다. 읽은 프레임은 버퍼에 넣습니다.
+    """
+    total_bytes = 0
+    total_duration = 0.0
+    for _ in range(ADTS_PROBE_FRAMES):
+        header = await stream.readexactly(7)
+        parsed = parse_adts_header(header)
+        if parsed is None:
+            raise ValueError("Lost ADTS sync")
+        frame_length, frame_duration = parsed
+        buffer["chunks"].append(header + await stream.readexactly(frame_length - 7))
+        total_bytes += frame_length
+        total_duration += frame_duration
+    return int(total_bytes / total_duration * SEGMENT_DURATION)
+
+async def read_adts_stream(stream, buffer):
+    """
+    ffmpeg stdout을 고정 크기 블록으로 읽어 버퍼에 추가합니다.
+    프레임마다 헤더를 파싱하지 않고, 처음에 측정한 비트레이트로 정한 바이트 수만큼만 유지합니다.
+    """
+    window_bytes = await probe_window_bytes(stream, buffer)
+    # 최근 window_bytes만 남도록 블록 단위로 오래된 데이터를 버림
+    # 측정에 쓴 작은 프레임들은 하나의 블록으로 합쳐, 블록 개수가 maxlen에 도달하면
+    # 항상 window_bytes 이상이 모이도록 함 (모든 블록 >= ADTS_READ_CHUNK)
+    chunks = collections.deque([b"".join(buffer["chunks"])], maxlen=-(-window_bytes // ADTS_READ_CHUNK))
+    buffer["chunks"] = chunks
+    while True:
+        chunks.append(await stream.readexactly(ADTS_READ_CHUNK))
+        if len(chunks) == chunks.maxlen:
+            buffer["ready"].set()
+
+def trim_to_adts_frames(data):
+    """Cut a byte window down to whole ADTS frames (blocks are not frame-aligned)"""
+    # 시작점: 연속된 두 프레임 헤더가 확인되는 첫 위치
+    start = data.find(b"\xff")
+    while start != -1:
+        parsed = parse_adts_header(data[start:start + 7])
+        if parsed and parse_adts_header(data[start + parsed[0]:start + parsed[0] + 7]):
+            break
+        start = data.find(b"\xff", start + 1)
+    if start == -1:
+        return b""
+
+    # 끝점: 마지막으로 완전히 들어 있는 프레임까지
+    end = start
+    while True:
+        parsed = parse_adts_header(data[end:end + 7])
+        if parsed is None or end + parsed[0] > len(data):
+            break
+        end += parsed[0]
+    return data[start:end]
+
+async def log_ffmpeg_stderr(stream, channel_id):
+    """Forward ffmpeg's stderr lines to the logger (also keeps the pipe drained)"""
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        log.warning("⚠️ [%s] ffmpeg: %s", channel_id, line.decode(errors='replace').rstrip())
+
+async def capture_stream(url, channel_id, buffer):
     """
-    ffmpeg를 사용하여 HLS 스트림에서 오디오 세그먼트를 캡처합니다.
+    ffmpeg 프로세스 하나를 계속 실행하여 HLS 스트림의 AAC를 그대로(ADTS) 받아
+    버퍼를 채웁니다. 세그먼트마다 프로세스를 새로 띄우지 않으므로 프로세스 생성과
+    HLS 재접속(m3u8 재요청) 비용이 없습니다. ffmpeg가 종료되면 다시 시작합니다.
     """
     # ffmpeg 명령어 구성
     cmd = [
         "ffmpeg",
         "-i", url,
-        "-t", str(duration),
         "-vn",
-        "-acodec", "pcm_s16le", # WAV로 변경하여 CPU 사용량 감소 (인코딩 부하 제거)
-        "-ar", "44100",
-        "-ac", "2",
-        "-f", "wav",
-        "-y",
+        "-c:a", "copy", # HLS의 AAC를 그대로 복사 (디코딩/인코딩 없음)
+        "-f", "adts",
         "-loglevel", "error",
-        output_file
+        "pipe:1"
     ]
-    
-    process = await asyncio.create_subprocess_exec(
-        *cmd,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    
-    stdout, stderr = await process.communicate()
-    
-    if process.returncode != 0:
-        print(f"Error capturing audio: {stderr.decode()}")
-        return False
-    return True
+
+    while True:
+        reset_audio_buffer(buffer)
+        process = None
+        stderr_task = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            # stderr를 계속 읽어 로거로 전달: 장시간 실행 중 파이프가 가득 차 ffmpeg가 멈추는 것도 방지
+            stderr_task = asyncio.create_task(log_ffmpeg_stderr(process.stderr, channel_id))
+            await read_adts_stream(process.stdout, buffer)
+        except asyncio.IncompleteReadError:
+            log.warning("⚠️ [%s] ffmpeg stream ended.", channel_id)
+        except Exception as e:
+            log.warning("⚠️ [%s] Error capturing audio: %s", channel_id, e)
+        finally:
+            if process is not None and process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    # 확인 직후 ffmpeg가 이미 종료된 경우
+                    pass
+                await process.wait()
+            if stderr_task is not None:
+                # 종료 직전의 에러 메시지까지 출력 (시간 초과 시 취소)
+                try:
+                    await asyncio.wait_for(stderr_task, timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+        log.warning("⚠️ [%s] Restarting ffmpeg in %ss...", channel_id, CAPTURE_RESTART_DELAY)
+        await asyncio.sleep(CAPTURE_RESTART_DELAY)
+
+async def get_audio_segment(buffer, timeout):
+    """
+    버퍼에 모인 최근 SEGMENT_DURATION초 분량의 AAC(ADTS) 바이트를 반환합니다.
+    timeout 안에 충분한 오디오가 모이지 않으면 None을 반환합니다.
+    """
+    try:
+        await asyncio.wait_for(buffer["ready"].wait(), timeout)
+    except asyncio.TimeoutError:
+        return None
+    return trim_to_adts_frames(b"".join(buffer["chunks"])) or None
 
 async def on_music_detected(track_info, channel_id):
     """
@@ -164,14 +546,14 @@ async def on_music_detected(track_info, channel_id):
     """
     title = track_info.get('title')
     subtitle = track_info.get('subtitle')
-    print(f"\n🎉 [{channel_id.upper()}] Music Found: {title} - {subtitle}")
+    log.info("🎉 [%s] Music Found: %s - %s", channel_id.upper(), title, subtitle)
     
     # Firebase 저장 (REST API)
     current_key = track_info.get('key')
     last_key = LAST_DETECTED_KEY.get(channel_id)
     
     if current_key and current_key == last_key:
-        print(f"   [{channel_id}] -> ⏭️ Same song detected ({current_key}). Skipping DB write.")
+        log.info("   [%s] -> ⏭️ Same song detected (%s). Skipping DB write.", channel_id, current_key)
         return
 
     if FIREBASE_READY:
@@ -181,79 +563,90 @@ async def on_music_detected(track_info, channel_id):
             # Mutate dictionary directly
             LAST_DETECTED_KEY[channel_id] = current_key
     else:
-        print(f"   [{channel_id}] -> 🚫 Firebase not ready")
+        log.info("   [%s] -> 🚫 Firebase not ready", channel_id)
 
-async def monitor_stream(url, channel_id, lock, start_delay=0):
+async def monitor_stream(url, channel_id, limiter, start_delay=0):
     """
     Monitor a specific stream URL for music.
     """
     if start_delay > 0:
-        print(f"⏳ [{channel_id.upper()}] Waiting {start_delay}s to start...")
+        log.info("⏳ [%s] Waiting %ss to start...", channel_id.upper(), start_delay)
         await asyncio.sleep(start_delay)
 
-    print(f"📡 Monitoring Stream [{channel_id.upper()}]: {url}")
-    
-    temp_file = f"temp_segment_{channel_id}.wav"
+    log.info("📡 Monitoring Stream [%s]: %s", channel_id.upper(), url)
     
     # Initialize state for this channel
     LAST_DETECTED_KEY[channel_id] = None
     LAST_SENT_STATUS[channel_id] = None
     
-    # Shazam 인스턴스 초기화
-    shazam = Shazam()
+    # Shazam 인스턴스 초기화 (HTTP 연결은 모든 채널이 공유)
+    shazam = Shazam(http_client=SHAZAM_HTTP_CLIENT)
 
-    while True:
-        try:
-            # 1. 오디오 캡처
-            success = await capture_audio_segment(url, SEGMENT_DURATION, temp_file)
+    # 오디오 캡처 (ffmpeg 한 개를 계속 실행하며 최근 오디오를 버퍼에 유지)
+    audio_buffer = new_audio_buffer()
+    capture_task = asyncio.create_task(capture_stream(url, channel_id, audio_buffer))
+
+    try:
+        while True:
+            tick_start = time.monotonic()
+            try:
+                # 1. 버퍼에서 최근 오디오 가져오기
+                audio_bytes = await get_audio_segment(audio_buffer, timeout=SEGMENT_DURATION * 2)
             
-            if success and os.path.exists(temp_file):
-                try:
-                    # API 호출 부분을 Lock으로 감싸서 동시 실행 방지
-                    async with lock:
-                        out = await shazam.recognize_song(temp_file)
+                if audio_bytes:
+                    try:
+                        # 채널 간 API 호출 속도만 제한 (인식 자체는 동시에 진행 가능)
+                        await limiter.acquire()
+                        # 메모리에 있는 오디오 바이트를 그대로 전달 (디스크 I/O 없음)
+                        out = await shazam.recognize(audio_bytes)
                         
-                    track = out.get('track')
+                        track = out.get('track')
                     
-                    if track:
-                        # 음악 감지 성공!
-                        await on_music_detected(track, channel_id)
-                        LAST_SENT_STATUS[channel_id] = 'music'
-                    else:
-                        # 음악 아님 (Speech, Noise)
+                        if track:
+                            # 음악 감지 성공!
+                            await on_music_detected(track, channel_id)
+                            LAST_SENT_STATUS[channel_id] = 'music'
+                        else:
+                            # 음악 아님 (Speech, Noise)
                         
-                        # 음악이 안 나오면 Now Playing 삭제
-                        if LAST_SENT_STATUS.get(channel_id) != 'empty':
-                            print(f"\n[{channel_id.upper()}] Speech/Noise detected (Music stopped).")
-                            if FIREBASE_READY:
-                                await clear_now_playing_rest(channel_id)
-                                print(f"   [{channel_id}] -> ⏹️ Cleared 'now_playing'.")
-                            LAST_DETECTED_KEY[channel_id] = None
-                            LAST_SENT_STATUS[channel_id] = 'empty'
-
-                except Exception as e:
-                    # 인식 중 에러 발생
-                    error_msg = str(e)
-                    if "URL is invalid" in error_msg:
-                        print(f"\n⚠️ [{channel_id}] Shazam API Issue (Rate Limit?): {error_msg}")
+                            # 음악이 안 나오면 Now Playing 삭제
+                            if LAST_SENT_STATUS.get(channel_id) != 'empty':
+                                log.info("[%s] Speech/Noise detected (Music stopped).", channel_id.upper())
+                                if FIREBASE_READY and await clear_now_playing_rest(channel_id):
+                                    log.info("   [%s] -> ⏹️ Cleared 'now_playing'.", channel_id)
+                                # 삭제 실패 시에도 상태를 갱신하여 매 주기마다 재요청하지 않음
+                                LAST_DETECTED_KEY[channel_id] = None
+                                LAST_SENT_STATUS[channel_id] = 'empty'
+
+                    except FailedDecodeJson as e:
+                        # Shazam이 JSON이 아닌 응답을 반환 (Rate Limit 등)
+                        log.warning("⚠️ [%s] Shazam API Issue (Rate Limit?): %s", channel_id, e)
                         # 에러 발생 시 더 길게 대기
+                        # (HTTP 세션은 공유되므로 Shazam 인스턴스를 새로 만들 필요 없음)
                         await asyncio.sleep(60)
-                        shazam = Shazam()
-                    else:
-                        print(f"\n[{channel_id}] Error during recognition: {e}")
-            else:
-                # 스트림 캡처 실패
-                print(f"\n⚠️ [{channel_id}] Stream capture failed. Retrying...")
-                await asyncio.sleep(30)
+                    except Exception as e:
+                        # 인식 중 에러 발생
+                        log.error("[%s] Error during recognition: %s", channel_id, e)
+                else:
+                    # 스트림 캡처 실패
+                    log.warning("⚠️ [%s] Stream capture failed. Retrying...", channel_id)
+                    await asyncio.sleep(30)
                 
-        except Exception as e:
-            print(f"\n[{channel_id}] Critical Error: {e}")
-            await asyncio.sleep(30)
+            except Exception as e:
+                log.error("[%s] Critical Error: %s", channel_id, e)
+                await asyncio.sleep(30)
             
-        # 반복 대기 (채널 별로 엇갈리게 실행하고 Random Jitter 추가)
-        # 기본 30초 + 0~5초 랜덤 추가 (간격 늘림)
-        wait_time = 30 + random.uniform(0, 5)
-        await asyncio.sleep(wait_time)
+            # 반복 대기: 고정 주기(monotonic 기준)로 실행하여 인식/네트워크 지연만큼 주기가 밀리지 않도록 함
+            # 채널 간 엇갈림은 start_delay로 유지
+            elapsed = time.monotonic() - tick_start
+            await asyncio.sleep(max(0, SEGMENT_DURATION + CYCLE_GAP - elapsed))
+    finally:
+        # ffmpeg 프로세스 정리
+        capture_task.cancel()
+        try:
+            await capture_task
+        except asyncio.CancelledError:
+            pass
 
 
 async def main():
@@ -265,20 +658,38 @@ async def main():
     fm_url = args.url or os.getenv("SHAZAMIO_HLS_URL") or "https://cdnfm.tbs.seoul.kr/tbs/_definst_/8434_tbs.stream_audio-only/playlist.m3u8"
     efm_url = "https://cdnefm.tbs.seoul.kr/tbs/_definst_/tbs_efm_app_360.smil/playlist.m3u8"
 
-    print("🚀 Starting ShazamIO Multi-Channel Detector... (FM & eFM) v2.0")
-    print("Option A: Separated DB paths (tbs_radio/fm/..., tbs_radio/efm/...)")
+    log.info("🚀 Starting ShazamIO Multi-Channel Detector... (FM & eFM) v2.0")
+    log.info("Option A: Separated DB paths (tbs_radio/fm/..., tbs_radio/efm/...)")
     
-    # 동시성 제어를 위한 Lock 생성
-    api_lock = asyncio.Lock()
+    # Shazam API 호출 속도 제한 (상호 배제 대신 토큰 버킷)
+    api_limiter = AsyncLimiter(max_rate=1, time_period=SHAZAM_RATE_PERIOD)
 
-    # 두 개의 모니터링 태스크 실행
-    await asyncio.gather(
-        monitor_stream(fm_url, "fm", api_lock, start_delay=0),
-        monitor_stream(efm_url, "efm", api_lock, start_delay=12) 
-    )
+    try:
+        # TaskGroup: 한 태스크가 예외로 종료되면 나머지도 취소되고 예외가 그대로 전달됨
+        # 따라서 각 태스크는 monitor_stream처럼 CancelledError 외의 예외를 스스로 처리하고 계속 실행함
+        async with asyncio.TaskGroup() as tg:
+            # 두 개의 모니터링 태스크 실행
+            tg.create_task(monitor_stream(fm_url, "fm", api_limiter, start_delay=0))
+            tg.create_task(monitor_stream(efm_url, "efm", api_limiter, start_delay=12))
+            if FIREBASE_READY:
+                # 토큰을 만료 전에 미리 갱신하여 저장 시점의 갱신 지연 제거
+                tg.create_task(token_refresher())
+                # 채널별 히스토리 일괄 저장
+                tg.create_task(history_flusher("fm"))
+                tg.create_task(history_flusher("efm"))
+    finally:
+        # 공유 HTTP 클라이언트 정리 (Ctrl+C 포함)
+        await close_http_client()
+        await close_shazam_client()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        # uvloop이 설치되어 있으면 libuv 기반 이벤트 루프 사용
+        loop_factory = uvloop.new_event_loop if uvloop else None
+        with asyncio.Runner(loop_factory=loop_factory) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
-        print("\n🛑 Monitoring Stopped.")
+        log.info("🛑 Monitoring Stopped.")
+    finally:
+        # 큐에 남은 로그를 모두 출력한 뒤 종료
+        LOG_LISTENER.stop()